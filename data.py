@@ -2,6 +2,7 @@
 # References:
     # https://github.com/KimRass/DCGAN/blob/main/celeba.py
 
+import torch
 from torch.utils.data import Dataset, DataLoader, DistributedSampler
 import torchvision.transforms as T
 from torchvision.datasets import CelebA
@@ -39,26 +40,65 @@ class CelebADS(Dataset):
         return self.transform(image=np.array(image))["image"]
 
 
-def get_train_and_val_dls(data_dir, img_size, batch_size, num_workers):
-    train_ds = CelebADS(data_dir=data_dir, split="train", img_size=img_size, hflip=True)
-    val_ds = CelebADS(data_dir=data_dir, split="valid", img_size=img_size, hflip=False)
+def get_cache_path(cache_dir, split, img_size):
+    return Path(cache_dir)/f"celeba_{split}_{img_size}.npy"
+
+
+# Reads the images cached by `preprocess.py`, already resized and center-cropped, so that the
+# workers neither decode JPEGs nor resize images.
+class CachedCelebADS(Dataset):
+    def __init__(self, cache_dir, split, img_size, hflip):
+        # `(N, H, W, 3)` `uint8` array, memory-mapped instead of read into memory.
+        self.images = np.load(get_cache_path(cache_dir, split, img_size), mmap_mode="r")
+        self.hflip = hflip
+
+    def __len__(self):
+        return len(self.images)
+
+    def __getitem__(self, idx):
+        image = torch.from_numpy(np.array(self.images[idx])).permute(2, 0, 1)
+        if self.hflip and torch.rand(size=()) < 0.5:
+            image = image.flip(dims=(2,))
+        # Scaled to $[-1, 1]$ as by `A.Normalize` in `CelebADS`.
+        return image.float().div_(127.5).sub_(1)
+
+
+def get_celeba_ds(data_dir, split, img_size, hflip, cache_dir=None):
+    if cache_dir is not None:
+        return CachedCelebADS(cache_dir=cache_dir, split=split, img_size=img_size, hflip=hflip)
+    return CelebADS(data_dir=data_dir, split=split, img_size=img_size, hflip=hflip)
+
+
+# Workers are kept alive across epochs and each keeps a few batches decoded ahead, so that
+# JPEG decoding does not stall the GPU at epoch boundaries.
+def get_train_and_val_dls(
+    data_dir, img_size, batch_size, num_workers, pin_memory=True, cache_dir=None,
+):
+    train_ds = get_celeba_ds(
+        data_dir=data_dir, split="train", img_size=img_size, hflip=True, cache_dir=cache_dir,
+    )
+    val_ds = get_celeba_ds(
+        data_dir=data_dir, split="valid", img_size=img_size, hflip=False, cache_dir=cache_dir,
+    )
     train_dl = DataLoader(
         train_ds,
         batch_size=batch_size,
         shuffle=True,
-        pin_memory=True,
+        pin_memory=pin_memory,
         drop_last=True,
-        persistent_workers=True,
         num_workers=num_workers,
+        persistent_workers=num_workers > 0,
+        prefetch_factor=4 if num_workers > 0 else None,
     )
     val_dl = DataLoader(
         val_ds,
         batch_size=batch_size,
         shuffle=False,
-        pin_memory=True,
+        pin_memory=pin_memory,
         drop_last=True,
-        persistent_workers=True,
         num_workers=num_workers,
+        persistent_workers=num_workers > 0,
+        prefetch_factor=4 if num_workers > 0 else None,
     )
     return train_dl, val_dl
 
@@ -77,10 +117,21 @@ def get_test_dl(data_dir, img_size, batch_size, num_workers):
 
 
 def get_train_and_val_dls_ddp(
-    data_dir, img_size, batch_size, num_workers, rank, world_size,
+    data_dir,
+    img_size,
+    batch_size,
+    num_workers,
+    rank,
+    world_size,
+    pin_memory=True,
+    cache_dir=None,
 ):
-    train_ds = CelebADS(data_dir=data_dir, split="train", img_size=img_size, hflip=True)
-    val_ds = CelebADS(data_dir=data_dir, split="valid", img_size=img_size, hflip=False)
+    train_ds = get_celeba_ds(
+        data_dir=data_dir, split="train", img_size=img_size, hflip=True, cache_dir=cache_dir,
+    )
+    val_ds = get_celeba_ds(
+        data_dir=data_dir, split="valid", img_size=img_size, hflip=False, cache_dir=cache_dir,
+    )
     train_sampler = DistributedSampler(
         train_ds, num_replicas=world_size, rank=rank, shuffle=True,
     )
@@ -91,19 +142,21 @@ def get_train_and_val_dls_ddp(
         train_ds,
         batch_size=batch_size,
         sampler=train_sampler,
-        pin_memory=True,
+        pin_memory=pin_memory,
         drop_last=True,
-        persistent_workers=True,
         num_workers=num_workers,
+        persistent_workers=num_workers > 0,
+        prefetch_factor=4 if num_workers > 0 else None,
     )
     val_dl = DataLoader(
         val_ds,
         batch_size=batch_size,
         sampler=val_sampler,
-        pin_memory=True,
+        pin_memory=pin_memory,
         drop_last=True,
-        persistent_workers=True,
         num_workers=num_workers,
+        persistent_workers=num_workers > 0,
+        prefetch_factor=4 if num_workers > 0 else None,
     )
     return train_dl, val_dl
 
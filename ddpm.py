@@ -10,16 +10,37 @@ import numpy as np
 import imageio
 from tqdm import tqdm
 import contextlib
+from concurrent.futures import ThreadPoolExecutor
 
 from data import CelebADS
-from utils import image_to_grid
+from utils import image_to_grid, get_autocast_dtype
+
+
+def reverse_step(
+    noisy_image,
+    pred_noise,
+    recip_sqrt_alpha_t,
+    beta_over_sqrt_one_minus_alpha_bar_t,
+    sigma_t,
+    rand_noise=None,
+):
+    # "Algorithm 2-4:
+    # $x_{t - 1} = \frac{1}{\sqrt{\alpha_{t}}}
+    # \Big(x_{t} - \frac{\beta_{t}}{\sqrt{1 - \bar{\alpha_{t}}}}z_{\theta}(x_{t}, t)\Big)
+    # + \sigma_{t}z"$
+    model_mean = recip_sqrt_alpha_t * (
+        noisy_image - beta_over_sqrt_one_minus_alpha_bar_t * pred_noise
+    )
+    if rand_noise is None:
+        return model_mean
+    return model_mean + sigma_t * rand_noise
 
 
 class DDPM(nn.Module):
     def get_linear_beta_schdule(self):
         # "We set the forward process variances to constants increasing linearly."
         # return torch.linspace(init_beta, fin_beta, n_diffusion_steps) # "$\beta_{t}$"
-        self.beta = torch.linspace(
+        return torch.linspace(
             self.init_beta,
             self.fin_beta,
             self.n_diffusion_steps,
@@ -37,6 +58,13 @@ class DDPM(nn.Module):
         n_diffusion_steps=1000,
         init_beta=0.0001,
         fin_beta=0.02,
+        sampling_dtype=None,
+        autocast_dtype=torch.float16,
+        use_cuda_graph=True,
+        compile_model=True,
+        compile_mode=None,
+        var_type="beta",
+        seed=None,
     ):
         super().__init__()
 
@@ -46,27 +74,112 @@ class DDPM(nn.Module):
         self.n_diffusion_steps = n_diffusion_steps
         self.init_beta = init_beta
         self.fin_beta = fin_beta
+        # BF16 where the GPU supports it natively, FP16 otherwise.
+        if sampling_dtype is None:
+            sampling_dtype = get_autocast_dtype(device=device)
+        self.sampling_dtype = sampling_dtype
+        self.autocast_dtype = autocast_dtype
+        # "reduce-overhead" and "max-autotune" make the compiled U-Net replay CUDA graphs of its
+        # own, which cannot be captured into the graphs of the denoising steps.
+        compile_uses_cuda_graph = (
+            compile_model and compile_mode in ["reduce-overhead", "max-autotune"]
+        )
+        self.use_cuda_graph = (
+            use_cuda_graph and self.device.type == "cuda" and not compile_uses_cuda_graph
+        )
+        # The diffusion steps and noise are drawn from a generator of their own, so that their
+        # RNG state is independent of other consumers of the default generator. Seeded from
+        # `torch.initial_seed()` by default, so that `set_seed()` still applies.
+        self.generator = torch.Generator(device=self.device)
+        self.generator.manual_seed(torch.initial_seed() if seed is None else seed)
+        # Captured denoising steps and their static buffers, keyed by input shape and mode.
+        self._cuda_graphs = dict()
+        # Noise of the denoising steps, keyed by batch size.
+        self._noise_bufs = dict()
 
-        self.model = model.to(device)
+        # NHWC lets cuDNN pick Tensor Core convolution kernels without internal layout
+        # transposes.
+        if self.device.type == "cuda":
+            self.memory_format = torch.channels_last
+        else:
+            self.memory_format = torch.contiguous_format
+        self.model = model.to(device, memory_format=self.memory_format)
+        # Compiled in place, so that the state dict keys stay the same. The default mode leaves
+        # the CUDA graphs to sampling, which captures whole denoising steps. The forward pass
+        # has no graph breaks, and `fullgraph` makes sure none creeps in.
+        if compile_model and self.device.type == "cuda" and hasattr(self.model, "compile"):
+            self.model.compile(mode=compile_mode, dynamic=False, fullgraph=True)
 
-        self.get_linear_beta_schdule()
-        self.alpha = 1 - self.beta # "$\alpha_{t} = 1 - \beta_{t}$"
+        # Non-persistent so that they move with `.to()` but stay out of the state dict.
+        beta = self.get_linear_beta_schdule()
+        alpha = 1 - beta # "$\alpha_{t} = 1 - \beta_{t}$"
         # "$\bar{\alpha_{t}} = \prod^{t}_{s=1}{\alpha_{s}}$"
-        self.alpha_bar = torch.cumprod(self.alpha, dim=0)
+        alpha_bar = torch.cumprod(alpha, dim=0)
+        self.register_buffer("beta", beta, persistent=False)
+        self.register_buffer("alpha", alpha, persistent=False)
+        self.register_buffer("alpha_bar", alpha_bar, persistent=False)
+
+        # "Experimentally, both $\sigma_{t}^{2} = \beta_{t}$ and
+        # $\sigma_{t}^{2} = \tilde{\beta}_{t} = \frac{1 - \bar{\alpha}_{t - 1}}{1 - \bar{\alpha}_{t}}\beta_{t}$
+        # had similar results."
+        assert var_type in ["beta", "posterior"], "var_type must be 'beta' or 'posterior'"
+        if var_type == "beta":
+            var = beta
+        else:
+            alpha_bar_prev = F.pad(alpha_bar[:-1], pad=(1, 0), value=1)
+            var = (1 - alpha_bar_prev) / (1 - alpha_bar) * beta
+
+        # Coefficients of the forward process and of "Algorithm 2-4", precomputed once for all
+        # diffusion steps with shape `(T, 1, 1, 1)` so that indexing them is a single gather
+        # whose result already broadcasts against `(B, C, H, W)` images.
+        sqrt_one_minus_alpha_bar = (1 - alpha_bar) ** 0.5
+        coeffs = {
+            "sqrt_alpha_bar": alpha_bar ** 0.5,
+            "sqrt_one_minus_alpha_bar": sqrt_one_minus_alpha_bar,
+            "recip_sqrt_alpha": 1 / (alpha ** 0.5),
+            "beta_over_sqrt_one_minus_alpha_bar": beta / sqrt_one_minus_alpha_bar,
+            "sigma": var ** 0.5, # "$\sigma_{t}$"
+        }
+        for name, coeff in coeffs.items():
+            self.register_buffer(name, coeff.view(-1, 1, 1, 1), persistent=False)
+
+        # Let TorchInductor fuse the elementwise math of the reverse step into a single kernel.
+        if compile_model and self.device.type == "cuda":
+            self.reverse_step = torch.compile(reverse_step, fullgraph=True)
+        else:
+            self.reverse_step = reverse_step
 
     @staticmethod
     def index(x, diffusion_step):
-        return x[diffusion_step][:, None, None, None]
+        # `(1, 1, 1)` for a single diffusion step given as an `int`. A tensor of diffusion steps,
+        # of shape `(B,)` or `(1,)`, is gathered with `index_select`, which never reads the
+        # diffusion steps back to the host and so can be captured into a CUDA graph.
+        if isinstance(diffusion_step, int):
+            return x[diffusion_step]
+        return x.index_select(0, diffusion_step)
 
     def sample_noise(self, batch_size):
-        return torch.randn(
+        return torch.empty(
             size=(batch_size, self.image_channels, self.img_size, self.img_size),
             device=self.device,
-        )
+            memory_format=self.memory_format,
+        ).normal_(generator=self.generator)
+
+    def _sample_denoising_noise(self, batch_size):
+        # Every denoising step consumes its noise right away, so it is drawn in place into a
+        # buffer reused across steps instead of a newly allocated tensor per step.
+        if batch_size not in self._noise_bufs:
+            self._noise_bufs[batch_size] = self.sample_noise(batch_size=batch_size)
+            return self._noise_bufs[batch_size]
+        return self._noise_bufs[batch_size].normal_(generator=self.generator)
 
     def sample_diffusion_step(self, batch_size):
         return torch.randint(
-            0, self.n_diffusion_steps, size=(batch_size,), device=self.device,
+            0,
+            self.n_diffusion_steps,
+            size=(batch_size,),
+            generator=self.generator,
+            device=self.device,
         )
 
     def batchify_diffusion_steps(self, diffusion_step_idx, batch_size):
@@ -78,20 +191,30 @@ class DDPM(nn.Module):
         )
 
     def perform_diffusion_process(self, ori_image, diffusion_step, rand_noise=None):
-        # "$\bar{\alpha_{t}}$"
-        alpha_bar_t = self.index(self.alpha_bar, diffusion_step=diffusion_step)
-        mean = (alpha_bar_t ** 0.5) * ori_image # $\sqrt{\bar{\alpha_{t}}}x_{0}$
-        var = 1 - alpha_bar_t # $(1 - \bar{\alpha_{t}})\mathbf{I}$
+        ori_image = ori_image.contiguous(memory_format=self.memory_format)
+        # $\sqrt{\bar{\alpha_{t}}}x_{0}$
+        mean = self.index(self.sqrt_alpha_bar, diffusion_step=diffusion_step) * ori_image
+        # Square root of $(1 - \bar{\alpha_{t}})\mathbf{I}$
+        std = self.index(self.sqrt_one_minus_alpha_bar, diffusion_step=diffusion_step)
         if rand_noise is None:
             rand_noise = self.sample_noise(batch_size=ori_image.size(0))
-        noisy_image = mean + (var ** 0.5) * rand_noise
+        noisy_image = mean + std * rand_noise
         return noisy_image
 
-    def forward(self, noisy_image, diffusion_step):
+    def forward(self, noisy_image, diffusion_step, temb=None):
         # "where $\epsilon_{\theta}$ is a function approximator intended to predict $\epsilon$ from $x_{t}$."
-        return self.model(noisy_image=noisy_image, diffusion_step=diffusion_step)
+        return self.model(noisy_image=noisy_image, diffusion_step=diffusion_step, temb=temb)
 
-    def get_loss(self, ori_image):
+    def get_loss(self, ori_image, denoiser=None, n_steps_per_image=1):
+        # `denoiser` is what predicts the noise, `self` by default. A `DistributedDataParallel`
+        # wrapper of `self` is passed instead so that the forward pass goes through it and the
+        # gradients get all-reduced.
+        if denoiser is None:
+            denoiser = self
+        # Each image is noised at `n_steps_per_image` independent diffusion steps, which lowers
+        # the variance of the loss for the images loaded.
+        if n_steps_per_image > 1:
+            ori_image = ori_image.repeat_interleave(n_steps_per_image, dim=0)
         # "Algorithm 1-3: $t \sim Uniform(\{1, \ldots, T\})$"
         rand_diffusion_step = self.sample_diffusion_step(batch_size=ori_image.size(0))
         rand_noise = self.sample_noise(batch_size=ori_image.size(0))
@@ -102,38 +225,126 @@ class DDPM(nn.Module):
             rand_noise=rand_noise,
         )
         with torch.autocast(
-            device_type=self.device.type, dtype=torch.float16,
+            device_type=self.device.type, dtype=self.autocast_dtype,
         ) if self.device.type == "cuda" else contextlib.nullcontext():
-            pred_noise = self(noisy_image=noisy_image, diffusion_step=rand_diffusion_step)
+            pred_noise = denoiser(noisy_image=noisy_image, diffusion_step=rand_diffusion_step)
             return F.mse_loss(pred_noise, rand_noise, reduction="mean")
 
-    @torch.inference_mode()
-    def take_denoising_step(self, noisy_image, diffusion_step_idx):
-        diffusion_step = self.batchify_diffusion_steps(
-            diffusion_step_idx=diffusion_step_idx, batch_size=noisy_image.size(0),
-        )
-        alpha_t = self.index(self.alpha, diffusion_step=diffusion_step)
-        beta_t = self.index(self.beta, diffusion_step=diffusion_step)
-        alpha_bar_t = self.index(self.alpha_bar, diffusion_step=diffusion_step)
-        pred_noise = self(noisy_image=noisy_image.detach(), diffusion_step=diffusion_step)
-        # # "Algorithm 2-4:
-        # $x_{t - 1} = \frac{1}{\sqrt{\alpha_{t}}}
-        # \Big(x_{t} - \frac{\beta_{t}}{\sqrt{1 - \bar{\alpha_{t}}}}z_{\theta}(x_{t}, t)\Big)
-        # + \sigma_{t}z"$
-        model_mean = (1 / (alpha_t ** 0.5)) * (
-            noisy_image - ((beta_t / ((1 - alpha_bar_t) ** 0.5)) * pred_noise)
+    def _denoise(self, noisy_image, diffusion_step, add_noise, temb_table=None):
+        recip_sqrt_alpha_t = self.index(self.recip_sqrt_alpha, diffusion_step=diffusion_step)
+        beta_over_sqrt_one_minus_alpha_bar_t = self.index(
+            self.beta_over_sqrt_one_minus_alpha_bar, diffusion_step=diffusion_step,
         )
-        # "At the end of sampling, we display $\mu_{\theta}(x_{1}, 1)$ noiselessly."
-        model_var = beta_t # "$\sigma_{t}$"
+        sigma_t = self.index(self.sigma, diffusion_step=diffusion_step)
+        if temb_table is not None:
+            temb = self.index(temb_table, diffusion_step=diffusion_step)
+        else:
+            temb = self.model.time_embedding(torch.as_tensor(diffusion_step, device=self.device))
+        # Only the network runs in reduced precision; the reverse step itself stays in FP32.
+        # The autocast cache is disabled so that this can be captured into a CUDA graph.
+        with torch.autocast(
+            device_type=self.device.type, dtype=self.sampling_dtype, cache_enabled=False,
+        ) if self.device.type == "cuda" else contextlib.nullcontext():
+            pred_noise = self(
+                noisy_image=noisy_image.detach(), diffusion_step=diffusion_step, temb=temb,
+            )
+        pred_noise = pred_noise.float()
 
-        if diffusion_step_idx > 0:
-            rand_noise = self.sample_noise(batch_size=noisy_image.size(0)) # "$z$"
+        # "At the end of sampling, we display $\mu_{\theta}(x_{1}, 1)$ noiselessly."
+        if add_noise:
+            rand_noise = self._sample_denoising_noise(batch_size=noisy_image.size(0)) # "$z$"
         else:
-            rand_noise = torch.zeros(
-                size=(noisy_image.size(0), self.image_channels, self.img_size, self.img_size),
-                device=self.device,
+            rand_noise = None
+        return self.reverse_step(
+            noisy_image=noisy_image,
+            pred_noise=pred_noise,
+            recip_sqrt_alpha_t=recip_sqrt_alpha_t,
+            beta_over_sqrt_one_minus_alpha_bar_t=beta_over_sqrt_one_minus_alpha_bar_t,
+            sigma_t=sigma_t,
+            rand_noise=rand_noise,
+        )
+
+    @torch.inference_mode()
+    def take_denoising_step(self, noisy_image, diffusion_step_idx, temb_table=None):
+        noisy_image = noisy_image.contiguous(memory_format=self.memory_format)
+        # All samples share the diffusion step, so it is not batchified.
+        return self._denoise(
+            noisy_image,
+            diffusion_step=diffusion_step_idx,
+            add_noise=diffusion_step_idx > 0,
+            temb_table=temb_table,
+        )
+
+    def _capture_denoising_step(
+        self, static_noisy_image, static_diffusion_step, add_noise, temb_table, pool=None,
+    ):
+        # Warm up on a side stream so that one-off work (cuDNN autotuning, compilation,
+        # allocations) happens before capture.
+        stream = torch.cuda.Stream()
+        stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(stream):
+            for _ in range(3):
+                self._denoise(
+                    static_noisy_image,
+                    diffusion_step=static_diffusion_step,
+                    add_noise=add_noise,
+                    temb_table=temb_table,
+                )
+        torch.cuda.current_stream().wait_stream(stream)
+
+        graph = torch.cuda.CUDAGraph()
+        # Every replay then advances the generator's Philox offset, as eager steps would.
+        graph.register_generator_state(self.generator)
+        with torch.cuda.graph(graph, pool=pool):
+            static_denoised_image = self._denoise(
+                static_noisy_image,
+                diffusion_step=static_diffusion_step,
+                add_noise=add_noise,
+                temb_table=temb_table,
             )
-        return model_mean + (model_var ** 0.5) * rand_noise
+        return graph, static_denoised_image
+
+    def _get_cuda_graphs(self, noisy_image, start_diffusion_step_idx, temb_table):
+        # Capturing costs a few warm-up steps, so the graphs are captured once per input shape
+        # and reused by later calls; only their static inputs are refreshed. The parameters
+        # are read in place, so training in between does not invalidate them.
+        key = (tuple(noisy_image.shape), self.training)
+        if key not in self._cuda_graphs:
+            x = noisy_image.clone(memory_format=self.memory_format)
+            # Of shape `(1,)` rather than 0-dim, which indexing would turn into a host sync
+            # and so freeze the diffusion step at capture into the graph.
+            static_diffusion_step = torch.tensor(
+                [start_diffusion_step_idx], dtype=torch.long, device=self.device,
+            )
+            static_temb_table = temb_table.clone()
+            graph, static_denoised_image = self._capture_denoising_step(
+                x, static_diffusion_step, add_noise=True, temb_table=static_temb_table,
+            )
+            # The last step adds no noise and gets its own graph.
+            last_graph, last_static_denoised_image = self._capture_denoising_step(
+                x,
+                static_diffusion_step,
+                add_noise=False,
+                temb_table=static_temb_table,
+                pool=graph.pool(),
+            )
+            self._cuda_graphs[key] = (
+                x,
+                static_diffusion_step,
+                static_temb_table,
+                graph,
+                static_denoised_image,
+                last_graph,
+                last_static_denoised_image,
+            )
+
+        # On a cache hit, the graphs read the diffusion step from `static_diffusion_step` on
+        # every replay, and `temb_table` is computed from the current weights by the caller.
+        x, static_diffusion_step, static_temb_table, *graphs = self._cuda_graphs[key]
+        x.copy_(noisy_image)
+        static_diffusion_step.fill_(start_diffusion_step_idx)
+        static_temb_table.copy_(temb_table)
+        return (x, static_diffusion_step, *graphs)
 
     @staticmethod
     def _get_frame(x):
@@ -141,22 +352,63 @@ class DDPM(nn.Module):
         frame = np.array(grid)
         return frame
 
-    def perform_denoising_process(self, noisy_image, start_diffusion_step_idx, n_frames=None):
+    @torch.inference_mode()
+    def perform_denoising_process(
+        self, noisy_image, start_diffusion_step_idx, n_frames=None, max_pending_frames=4,
+    ):
         if n_frames is not None:
+            # Frames are assembled in a background thread so that the grid building does not
+            # hold up the next denoising steps.
+            executor = ThreadPoolExecutor(max_workers=1)
             frames = list()
 
-        x = noisy_image
+        # The time embedding only depends on the diffusion step, so compute it once for all
+        # steps instead of once per step.
+        temb_table = self.model.precompute_time_embeddings(
+            self.n_diffusion_steps, device=self.device,
+        )
+        if self.use_cuda_graph:
+            # Every step has the same shapes, so capture one step into a CUDA graph and replay
+            # it, only updating the diffusion step in place.
+            x, static_diffusion_step, graph, static_denoised_image, last_graph, \
+                last_static_denoised_image = self._get_cuda_graphs(
+                    noisy_image, start_diffusion_step_idx=start_diffusion_step_idx,
+                    temb_table=temb_table,
+                )
+        else:
+            x = noisy_image
+
         pbar = tqdm(range(start_diffusion_step_idx, -1, -1), leave=False)
         for diffusion_step_idx in pbar:
             pbar.set_description("Denoising...")
 
-            x = self.take_denoising_step(x, diffusion_step_idx=diffusion_step_idx)
+            if self.use_cuda_graph:
+                static_diffusion_step.fill_(diffusion_step_idx)
+                if diffusion_step_idx > 0:
+                    graph.replay()
+                    x.copy_(static_denoised_image)
+                else:
+                    last_graph.replay()
+                    x.copy_(last_static_denoised_image)
+            else:
+                x = self.take_denoising_step(
+                    x, diffusion_step_idx=diffusion_step_idx, temb_table=temb_table,
+                )
 
             if n_frames is not None and (
                 diffusion_step_idx % (self.n_diffusion_steps // n_frames) == 0
             ):
-                frames.append(self._get_frame(x))
-        return frames if n_frames is not None else x
+                # Bound the number of frames waiting to be assembled.
+                if len(frames) >= max_pending_frames:
+                    frames[-max_pending_frames].result()
+                frames.append(executor.submit(self._get_frame, x.cpu()))
+
+        if n_frames is not None:
+            frames = [frame.result() for frame in frames]
+            executor.shutdown()
+            return frames
+        # The captured graphs keep writing into `x`, so hand out a copy of it.
+        return x.clone() if self.use_cuda_graph else x
 
     def sample(self, batch_size):
         rand_noise = self.sample_noise(batch_size=batch_size) # "$x_{T}$"
@@ -189,11 +441,7 @@ class DDPM(nn.Module):
         )[:, None, None, None]
         return (1 - weight) * x + weight * y
 
-    def interpolate(self, data_dir, image_idx1, image_idx2, interpolate_at=500, n_points=10):
-        ori_image1, ori_image2 = self._get_ori_images(
-            data_dir=data_dir, image_idx1=image_idx1, image_idx2=image_idx2,
-        )
-
+    def _get_noisy_interpolated_image(self, ori_image1, ori_image2, interpolate_at, n_points):
         diffusion_step = self.batchify_diffusion_steps(interpolate_at, batch_size=1)
         noisy_image1 = self.perform_diffusion_process(
             ori_image=ori_image1, diffusion_step=diffusion_step,
@@ -201,8 +449,18 @@ class DDPM(nn.Module):
         noisy_image2 = self.perform_diffusion_process(
             ori_image=ori_image2, diffusion_step=diffusion_step,
         )
+        return self._get_linearly_interpolated_image(
+            noisy_image1, noisy_image2, n_points=n_points,
+        )
 
-        x = self._get_linearly_interpolated_image(noisy_image1, noisy_image2, n_points=n_points)
+    def interpolate(self, data_dir, image_idx1, image_idx2, interpolate_at=500, n_points=10):
+        ori_image1, ori_image2 = self._get_ori_images(
+            data_dir=data_dir, image_idx1=image_idx1, image_idx2=image_idx2,
+        )
+
+        x = self._get_noisy_interpolated_image(
+            ori_image1, ori_image2, interpolate_at=interpolate_at, n_points=n_points,
+        )
         denoised_image = self.perform_denoising_process(
             noisy_image=x,
             start_diffusion_step_idx=interpolate_at,
@@ -210,25 +468,67 @@ class DDPM(nn.Module):
         )
         return torch.cat([ori_image1, denoised_image, ori_image2], dim=0)
 
+    @torch.inference_mode()
+    def _perform_staggered_denoising_process(self, noisy_image, start_diffusion_step_idxs):
+        # The whole batch goes through every step, and the samples that have not started being
+        # denoised yet keep their noisy images, so that the compiled U-Net always sees the same
+        # input shape instead of one per number of started samples.
+        temb_table = self.model.precompute_time_embeddings(
+            self.n_diffusion_steps, device=self.device,
+        )
+        pbar = tqdm(range(max(start_diffusion_step_idxs), -1, -1), leave=False)
+        start_diffusion_step_idxs = torch.tensor(
+            start_diffusion_step_idxs, device=self.device,
+        )[:, None, None, None]
+        x = noisy_image
+        for diffusion_step_idx in pbar:
+            pbar.set_description("Denoising...")
+
+            denoised_image = self.take_denoising_step(
+                x, diffusion_step_idx=diffusion_step_idx, temb_table=temb_table,
+            )
+            x = torch.where(
+                start_diffusion_step_idxs >= diffusion_step_idx, denoised_image, x,
+            )
+        return x
+
     def coarse_to_fine_interpolate(self, data_dir, image_idx1, image_idx2, n_rows=9, n_points=10):
-        rows = list()
-        pbar = tqdm(
+        ori_image1, ori_image2 = self._get_ori_images(
+            data_dir=data_dir, image_idx1=image_idx1, image_idx2=image_idx2,
+        )
+
+        # Denoise all rows as one batch instead of running one denoising process per row.
+        interpolate_ats = list(
             range(
                 self.n_diffusion_steps - 1,
                 -1,
                 - self.n_diffusion_steps // (n_rows - 1),
-            ),
-            leave=False,
-        )
-        for interpolate_at in pbar:
-            pbar.set_description("Coarse to fine interpolating...")
-
-            row = self.interpolate(
-                data_dir=data_dir,
-                image_idx1=image_idx1,
-                image_idx2=image_idx2,
-                interpolate_at=interpolate_at,
-                n_points=n_points,
             )
-            rows.append(row)
-        return torch.cat(rows, dim=0)
+        )
+        x = torch.cat(
+            [
+                self._get_noisy_interpolated_image(
+                    ori_image1, ori_image2, interpolate_at=interpolate_at, n_points=n_points,
+                )
+                for interpolate_at in interpolate_ats
+            ],
+            dim=0,
+        )
+        denoised_image = self._perform_staggered_denoising_process(
+            noisy_image=x,
+            start_diffusion_step_idxs=[
+                interpolate_at for interpolate_at in interpolate_ats for _ in range(n_points)
+            ],
+        )
+
+        n_rows = len(interpolate_ats)
+        denoised_image = denoised_image.reshape(n_rows, n_points, *denoised_image.shape[1:])
+        rows = torch.cat(
+            [
+                ori_image1[None, ...].expand(n_rows, -1, -1, -1, -1),
+                denoised_image,
+                ori_image2[None, ...].expand(n_rows, -1, -1, -1, -1),
+            ],
+            dim=1,
+        )
+        return rows.reshape(-1, *rows.shape[2:])
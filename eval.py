@@ -6,11 +6,11 @@
 import torch
 import torch.nn.functional as F
 from torch.utils.data import DataLoader
-import numpy as np
-import scipy
 from tqdm import tqdm
 import math
 import argparse
+import contextlib
+import os
 
 from inceptionv3 import InceptionV3
 from data import CelebADS, ImageGridDataset
@@ -25,7 +25,11 @@ def get_args():
     parser.add_argument("--batch_size", type=int, required=True)
     parser.add_argument("--n_eval_imgs", type=int, required=True)
 
-    parser.add_argument("--n_cpus", type=int, required=False, default=0)
+    # Worker processes decode images while Inception-v3 runs on the GPU. On multi-socket
+    # machines, keep this within the cores of the GPU's NUMA node.
+    parser.add_argument(
+        "--n_cpus", type=int, required=False, default=max(1, (os.cpu_count() or 2) // 2),
+    )
     parser.add_argument("--padding", type=int, required=False, default=1)
     parser.add_argument("--n_cells", type=int, required=False, default=100)
 
@@ -34,21 +38,28 @@ def get_args():
 
 
 def get_matrix_sqrt(x):
-    conv_mean = scipy.linalg.sqrtm(x)
-    if np.iscomplexobj(conv_mean):
-        conv_mean = conv_mean.real
-    return conv_mean
+    # Square root of a symmetric positive semi-definite matrix via its eigendecomposition.
+    # `eigh` only reads one triangle, so symmetrize first to average out round-off.
+    x = (x + x.T) / 2
+    eigval, eigvec = torch.linalg.eigh(x)
+    return (eigvec * eigval.clamp(min=0).sqrt()) @ eigvec.T
 
 
 def get_mean_and_cov(embed):
-    mu = embed.mean(axis=0)
-    sigma = np.cov(embed, rowvar=False)
+    embed = embed.double()
+    mu = embed.mean(dim=0)
+    centered = embed - mu
+    sigma = (centered.T @ centered) / (embed.size(0) - 1)
     return mu, sigma
 
 
 def get_frechet_distance(mu1, mu2, sigma1, sigma2):
-    cov_mean = get_matrix_sqrt(sigma1 @ sigma2)
-    fd = ((mu1 - mu2) ** 2).sum() + np.trace(sigma1 + sigma2 - 2 * cov_mean)
+    # $Tr((\Sigma_{1}\Sigma_{2})^{1/2}) = Tr((\Sigma_{1}^{1/2}\Sigma_{2}\Sigma_{1}^{1/2})^{1/2})$,
+    # and the latter matrix is symmetric so its eigenvalues can be found with `eigvalsh`.
+    sqrt_sigma1 = get_matrix_sqrt(sigma1)
+    eigval = torch.linalg.eigvalsh(sqrt_sigma1 @ sigma2 @ sqrt_sigma1)
+    trace_cov_mean = eigval.clamp(min=0).sqrt().sum()
+    fd = ((mu1 - mu2) ** 2).sum() + torch.trace(sigma1) + torch.trace(sigma2) - 2 * trace_cov_mean
     return fd.item()
 
 
@@ -61,23 +72,29 @@ def get_fid(embed1, embed2):
 
 def get_inception_score(prob, eps=1e-16):
     p_yx = prob # $p(y|x)$
-    p_y = p_yx.mean(axis=0, keepdims=True) # $p(y)$
-    kld = p_yx * np.log((p_yx + eps) / (p_y + eps)) # $p(y|x)\log(P(y|x) / P(y))$
-    sum_kld = kld.sum(axis=1)
+    p_y = p_yx.mean(dim=0, keepdim=True) # $p(y)$
+    kld = p_yx * torch.log((p_yx + eps) / (p_y + eps)) # $p(y|x)\log(P(y|x) / P(y))$
+    sum_kld = kld.sum(dim=1)
     avg_kld = sum_kld.mean()
-    inception_score = np.exp(avg_kld)
-    return inception_score
+    inception_score = torch.exp(avg_kld)
+    return inception_score.item()
 
 
-def get_dls(real_data_dir, gen_data_dir, batch_size, img_size, n_cpus, n_cells, padding):
+def get_dls(
+    real_data_dir, gen_data_dir, batch_size, img_size, n_cpus, n_cells, padding, device,
+):
+    # Page-locked batches only speed up copies to a CUDA device.
+    pin_memory = device.type == "cuda"
     real_ds = CelebADS(data_dir=real_data_dir, img_size=img_size)
     real_dl = DataLoader(
         real_ds,
         batch_size=batch_size,
         shuffle=True,
         num_workers=n_cpus,
-        pin_memory=False,
+        pin_memory=pin_memory,
         drop_last=False,
+        persistent_workers=n_cpus > 0,
+        prefetch_factor=4 if n_cpus > 0 else None,
     )
     gen_ds = ImageGridDataset(
         data_dir=gen_data_dir,
@@ -90,8 +107,10 @@ def get_dls(real_data_dir, gen_data_dir, batch_size, img_size, n_cpus, n_cells,
         batch_size=batch_size,
         shuffle=True,
         num_workers=n_cpus,
-        pin_memory=False,
+        pin_memory=pin_memory,
         drop_last=False,
+        persistent_workers=n_cpus > 0,
+        prefetch_factor=4 if n_cpus > 0 else None,
     )
     return real_dl, gen_dl
 
@@ -117,45 +136,71 @@ class Evaluator(object):
         self.model1.eval()
         self.model2.eval()
 
-        self.process_real_dl()
+        self.process_real_dl(self.real_dl)
 
-    @torch.no_grad()
-    def process_gen_dl(self, gen_dl):
-        embeds = list()
-        gen_di = iter(gen_dl)
-        for _ in tqdm(range(math.ceil(self.n_eval_imgs / self.batch_size))):
-            x0 = next(gen_di)
-            x0 = x0.to(self.device)
-
-            out = self.model1(x0.detach())
-            embed = out[0]
-            embeds.append(embed.squeeze().detach().cpu().numpy())
-        self.real_embed = np.concatenate(embeds)[: self.n_eval_imgs]
-
-    @torch.no_grad()
+    @torch.inference_mode()
     def process_real_dl(self, real_dl):
-        embeds = list()
-        probs = list()
-        real_di = iter(real_dl)
-        for _ in tqdm(range(math.ceil(self.n_eval_imgs / self.batch_size))):
-            x0 = next(real_di)
-            x0 = x0.to(self.device)
-
-            out = self.model2(x0.detach())
-            embed = out[0]
-            embeds.append(embed.squeeze().detach().cpu().numpy())
+        # Embeddings are written into a single preallocated tensor on the device instead of
+        # being collected batch by batch. Only the first `n_filled` rows are written if the
+        # data loader runs out of images first.
+        embeds = None
+        n_filled = 0
+        for x0 in tqdm(real_dl, total=math.ceil(self.n_eval_imgs / self.batch_size)):
+            x0 = x0.to(self.device, non_blocking=True)
+
+            with torch.autocast(
+                device_type=self.device.type, dtype=torch.float16,
+            ) if self.device.type == "cuda" else contextlib.nullcontext():
+                out = self.model1(x0)
+            embed = out[0].flatten(start_dim=1)
+            if embeds is None:
+                embeds = torch.empty(
+                    size=(self.n_eval_imgs, embed.size(1)), device=self.device,
+                )
+            end = min(n_filled + embed.size(0), self.n_eval_imgs)
+            embeds[n_filled: end] = embed[: end - n_filled]
+            n_filled = end
+            if n_filled == self.n_eval_imgs:
+                break
+        self.real_embed = embeds[: n_filled]
+
+    @torch.inference_mode()
+    def process_gen_dl(self, gen_dl):
+        embeds = None
+        probs = None
+        n_filled = 0
+        for x0 in tqdm(gen_dl, total=math.ceil(self.n_eval_imgs / self.batch_size)):
+            x0 = x0.to(self.device, non_blocking=True)
+
+            with torch.autocast(
+                device_type=self.device.type, dtype=torch.float16,
+            ) if self.device.type == "cuda" else contextlib.nullcontext():
+                out = self.model2(x0)
+            embed = out[0].flatten(start_dim=1)
+            if embeds is None:
+                embeds = torch.empty(
+                    size=(self.n_eval_imgs, embed.size(1)), device=self.device,
+                )
+            end = min(n_filled + embed.size(0), self.n_eval_imgs)
+            embeds[n_filled: end] = embed[: end - n_filled]
 
             if self.mode in ["is", "both"]:
                 logit = out[1]
-                prob = F.softmax(logit, dim=1)
-                probs.append(prob.detach().cpu().numpy())
-        gen_embed = np.concatenate(embeds)[: self.n_eval_imgs]
-        if self.mode in ["is", "both"]:
-            gen_prob = np.concatenate(probs)[: self.n_eval_imgs]
-        return gen_embed, gen_prob if self.mode in ["is", "both"] else gen_embed
+                prob = F.softmax(logit.float(), dim=1)
+                if probs is None:
+                    probs = torch.empty(
+                        size=(self.n_eval_imgs, prob.size(1)), device=self.device,
+                    )
+                probs[n_filled: end] = prob[: end - n_filled]
+            n_filled = end
+            if n_filled == self.n_eval_imgs:
+                break
+        gen_embed = embeds[: n_filled]
+        gen_prob = probs[: n_filled] if probs is not None else None
+        return gen_embed, gen_prob
 
     def evaluate(self):
-        gen_embed, gen_prob = self.process_real_dl()
+        gen_embed, gen_prob = self.process_gen_dl(self.gen_dl)
         fid = get_fid(self.real_embed, gen_embed)
         print(f"[ FID: {fid:.2f} ]")
         if self.mode in ["is", "both"]:
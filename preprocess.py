@@ -0,0 +1,78 @@
+# Decodes, resizes and center-crops the CelebA images once, and caches them as a `uint8` array of
+# shape `(N, H, W, 3)` per split, which `CachedCelebADS` memory-maps during training.
+
+import torch
+from torch.utils.data import Dataset, DataLoader
+from torchvision.datasets import CelebA
+import albumentations as A
+import cv2
+import numpy as np
+import argparse
+from tqdm import tqdm
+
+from data import get_cache_path
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--data_dir", type=str, required=True)
+    parser.add_argument("--cache_dir", type=str, required=True)
+    parser.add_argument("--img_size", type=int, required=True)
+    parser.add_argument("--n_cpus", type=int, default=4, required=False)
+
+    args = parser.parse_args()
+
+    args_dict = vars(args)
+    new_args_dict = dict()
+    for k, v in args_dict.items():
+        new_args_dict[k.upper()] = v
+    args = argparse.Namespace(**new_args_dict)
+    return args
+
+
+class CelebAResizeDS(Dataset):
+    def __init__(self, data_dir, split, img_size):
+        self.ds = CelebA(root=data_dir, split=split, download=True)
+
+        # The deterministic part of the transforms of `CelebADS`.
+        self.transform = A.Compose(
+            [
+                A.SmallestMaxSize(max_size=img_size, interpolation=cv2.INTER_AREA),
+                A.CenterCrop(height=img_size, width=img_size),
+            ]
+        )
+
+    def __len__(self):
+        return len(self.ds)
+
+    def __getitem__(self, idx):
+        image, _ = self.ds[idx]
+        return torch.from_numpy(self.transform(image=np.array(image))["image"])
+
+
+def main():
+    args = get_args()
+
+    for split in ["train", "valid", "test"]:
+        ds = CelebAResizeDS(data_dir=args.DATA_DIR, split=split, img_size=args.IMG_SIZE)
+        dl = DataLoader(ds, batch_size=256, shuffle=False, num_workers=args.N_CPUS)
+
+        cache_path = get_cache_path(args.CACHE_DIR, split=split, img_size=args.IMG_SIZE)
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        images = np.lib.format.open_memmap(
+            cache_path,
+            mode="w+",
+            dtype=np.uint8,
+            shape=(len(ds), args.IMG_SIZE, args.IMG_SIZE, 3),
+        )
+        start = 0
+        for image in tqdm(dl, desc=f"Caching '{split}'..."):
+            images[start: start + image.size(0)] = image.numpy()
+            start += image.size(0)
+        images.flush()
+        print(f"Cached {len(ds):,} images as '{str(cache_path)}'.")
+
+
+if __name__ == "__main__":
+    main()
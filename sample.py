@@ -4,7 +4,7 @@
 import torch
 import argparse
 
-from utils import get_device, image_to_grid, save_image
+from utils import get_device, get_autocast_dtype, image_to_grid, save_image
 from unet import UNet
 from ddpm import DDPM
 
@@ -21,6 +21,10 @@ def get_args():
     parser.add_argument("--model_params", type=str, required=True)
     parser.add_argument("--save_path", type=str, required=True)
     parser.add_argument("--img_size", type=int, required=True)
+    # $\sigma_{t}^{2}$ of the reverse process: $\beta_{t}$ or $\tilde{\beta}_{t}$.
+    parser.add_argument(
+        "--var_type", type=str, default="beta", choices=["beta", "posterior"], required=False,
+    )
 
     # For `"normal"`, `"denoising_process"`
     parser.add_argument("--batch_size", type=int, required=False)
@@ -55,9 +59,16 @@ def main():
     print(f"[ DEVICE: {DEVICE} ]")
     
     net = UNet()
-    model = DDPM(model=net, img_size=args.IMG_SIZE, device=DEVICE)
+    model = DDPM(
+        model=net,
+        img_size=args.IMG_SIZE,
+        device=DEVICE,
+        sampling_dtype=get_autocast_dtype(device=DEVICE),
+        var_type=args.VAR_TYPE,
+    )
     state_dict = torch.load(str(args.MODEL_PARAMS), map_location=DEVICE)
     model.load_state_dict(state_dict)
+    model.eval()
 
     if args.MODE == "denoising_process":
         model.vis_denoising_process(
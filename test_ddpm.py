@@ -0,0 +1,105 @@
+import pytest
+import torch
+
+from unet import UNet
+from ddpm import DDPM
+
+requires_cuda = pytest.mark.skipif(
+    not torch.cuda.is_available(), reason="CUDA graphs need a CUDA device",
+)
+
+
+def get_ddpm(device):
+    torch.manual_seed(0)
+    net = UNet(ch=32, ch_mult=[1, 2], attn=[1], num_res_blocks=1, dropout=0)
+    model = DDPM(model=net, img_size=16, device=device, compile_model=False, seed=0)
+    model.eval()
+    return model
+
+
+@requires_cuda
+@torch.inference_mode()
+def test_cuda_graph_replays_the_current_diffusion_step():
+    model = get_ddpm(device=torch.device("cuda"))
+    noisy_image = model.sample_noise(batch_size=4)
+    temb_table = model.model.precompute_time_embeddings(
+        model.n_diffusion_steps, device=model.device,
+    )
+    x, static_diffusion_step, _, _, last_graph, last_static_denoised_image = (
+        model._get_cuda_graphs(
+            noisy_image, start_diffusion_step_idx=999, temb_table=temb_table,
+        )
+    )
+
+    # The graph without noise is compared, so that eager steps draw no noise either.
+    denoised_images = list()
+    for diffusion_step_idx in [999, 500]:
+        x.copy_(noisy_image)
+        static_diffusion_step.fill_(diffusion_step_idx)
+        last_graph.replay()
+        expected = model._denoise(
+            noisy_image.clone(),
+            diffusion_step=diffusion_step_idx,
+            add_noise=False,
+            temb_table=temb_table,
+        )
+        torch.testing.assert_close(last_static_denoised_image, expected, rtol=1e-3, atol=1e-3)
+        denoised_images.append(last_static_denoised_image.clone())
+    assert not torch.allclose(denoised_images[0], denoised_images[1])
+
+
+@requires_cuda
+def test_cached_cuda_graphs_follow_weight_updates():
+    model = get_ddpm(device=torch.device("cuda"))
+    with torch.inference_mode():
+        noisy_image = model.sample_noise(batch_size=4)
+        model._get_cuda_graphs(
+            noisy_image,
+            start_diffusion_step_idx=999,
+            temb_table=model.model.precompute_time_embeddings(
+                model.n_diffusion_steps, device=model.device,
+            ),
+        )
+
+    # As an optimizer step would, update the weights in place, including those of the time
+    # embedding.
+    with torch.no_grad():
+        for param in model.parameters():
+            param.mul_(1.01)
+
+    with torch.inference_mode():
+        temb_table = model.model.precompute_time_embeddings(
+            model.n_diffusion_steps, device=model.device,
+        )
+        x, static_diffusion_step, _, _, last_graph, last_static_denoised_image = (
+            model._get_cuda_graphs(
+                noisy_image, start_diffusion_step_idx=300, temb_table=temb_table,
+            )
+        )
+        assert len(model._cuda_graphs) == 1
+        last_graph.replay()
+        expected = model._denoise(
+            noisy_image.clone(), diffusion_step=300, add_noise=False, temb_table=temb_table,
+        )
+        torch.testing.assert_close(last_static_denoised_image, expected, rtol=1e-3, atol=1e-3)
+
+
+def test_get_loss_draws_a_diffusion_step_and_noise_per_copy():
+    model = get_ddpm(device=torch.device("cpu"))
+    inputs = dict()
+
+    def denoiser(noisy_image, diffusion_step):
+        inputs["noisy_image"] = noisy_image
+        inputs["diffusion_step"] = diffusion_step
+        return torch.zeros_like(noisy_image)
+
+    # Zero images, so that the noisy images differ only by their diffusion steps and noise.
+    ori_image = torch.zeros(size=(2, 3, 16, 16))
+    model.get_loss(ori_image, denoiser=denoiser, n_steps_per_image=4)
+    assert list(inputs["noisy_image"].shape) == [8, 3, 16, 16]
+    assert list(inputs["diffusion_step"].shape) == [8]
+
+    # The copies of the first image.
+    assert len(set(inputs["diffusion_step"][:4].tolist())) > 1
+    noisy_image = inputs["noisy_image"][:4].flatten(start_dim=1)
+    assert len(set(noisy_image[:, 0].tolist())) == 4
@@ -6,8 +6,11 @@
 import torch
 from torch.optim import AdamW
 import gc
+import os
 import argparse
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 import math
 from time import time
 from tqdm import tqdm
@@ -18,12 +21,15 @@ import wandb
 from utils import (
     set_seed,
     get_device,
+    get_autocast_dtype,
     get_grad_scaler,
     get_elapsed_time,
     modify_state_dict,
     print_n_params,
+    to_cpu,
     image_to_grid,
     save_image,
+    positive_int,
 )
 from data import get_train_and_val_dls
 from unet import UNet
@@ -41,8 +47,32 @@ def get_args():
     parser.add_argument("--n_cpus", type=int, required=True)
     parser.add_argument("--n_warmup_steps", type=int, required=True)
     parser.add_argument("--img_size", type=int, required=True)
-
+    # Directory of the images cached by `preprocess.py`; `data_dir` is read if not given.
+    parser.add_argument("--cache_dir", type=str, default=None, required=False)
+
+    # Mode of `torch.compile` for the U-Net; "reduce-overhead" replays CUDA graphs of each
+    # training step.
+    parser.add_argument(
+        "--compile_mode",
+        type=str,
+        choices=("default", "reduce-overhead", "max-autotune", "max-autotune-no-cudagraphs"),
+        default=None,
+        required=False,
+    )
+    # The checkpoint is saved every `ckpt_every` epochs, and whenever the val loss improves.
+    parser.add_argument("--ckpt_every", type=int, default=5, required=False)
+    # Validate on only the first `val_batches` batches of the val set instead of all of them.
+    parser.add_argument("--val_batches", type=positive_int, default=None, required=False)
+    # Number of diffusion steps each training image is noised at per training step; the
+    # U-Net then sees `batch_size * n_steps_per_image` samples per step.
+    parser.add_argument(
+        "--n_steps_per_image", type=positive_int, default=1, required=False,
+    )
+    # Also write the samples logged to W&B after each epoch to `save_dir`.
+    parser.add_argument("--save_samples", action="store_true")
     parser.add_argument("--seed", type=int, default=223, required=False)
+    # Restrict cuDNN to deterministic algorithms instead of autotuning for the fastest ones.
+    parser.add_argument("--deterministic", action="store_true")
 
     args = parser.parse_args()
 
@@ -63,20 +93,22 @@ class EMA:
         self.ema_model = deepcopy(model)
         self.ema_model.eval()
         self.ema_model.requires_grad_(False)
+        # Updated in place with multi-tensor ops, which launch a few kernels for all the
+        # parameters instead of a few per parameter.
+        self.ema_params = [param.data for param in self.ema_model.parameters()]
 
         self.cur_step = 0
 
     def _reset_model_prams(self, cur_model):
-        self.ema_model.load_state_dict(cur_model.state_dict())
-
-    def _get_ema(self, x, y):
-        if x is None:
-            return y
-        return self.weight * x + (1 - self.weight) * y
+        torch._foreach_copy_(self.ema_params, [param.data for param in cur_model.parameters()])
 
     def _update_model_params(self, cur_model):
-        for cur_param, ema_param in zip(cur_model.parameters(), self.ema_model.parameters()):
-            ema_param.data = self._get_ema(ema_param.data, cur_param.data)
+        # `weight * ema_param + (1 - weight) * cur_param`
+        torch._foreach_lerp_(
+            self.ema_params,
+            [param.data for param in cur_model.parameters()],
+            1 - self.weight,
+        )
 
     def step(self, cur_model, start_step=2000):
         if self.cur_step < start_step:
@@ -87,85 +119,131 @@ class EMA:
 
 
 class Trainer(object):
-    def __init__(self, train_dl, val_dl, save_dir, device):
+    def __init__(
+        self,
+        train_dl,
+        val_dl,
+        save_dir,
+        device,
+        save_samples=False,
+        ckpt_every=5,
+        val_batches=None,
+        n_steps_per_image=1,
+    ):
         self.train_dl = train_dl
         self.val_dl = val_dl
         self.save_dir = Path(save_dir)
         self.device = device
+        self.save_samples = save_samples
+        self.ckpt_every = ckpt_every
+        self.n_steps_per_image = n_steps_per_image
+        # The val loss is a Monte Carlo estimate over random diffusion steps anyway, so a
+        # subset of the val set is enough to monitor it.
+        if val_batches is None:
+            self.n_val_batches = len(val_dl)
+        else:
+            self.n_val_batches = min(val_batches, len(val_dl))
+        assert self.n_val_batches > 0, "The val set yields no batch to validate on."
 
         self.run = wandb.init(project="DDPM")
 
         self.ckpt_path = self.save_dir/"ckpt.pth"
+        # Checkpoints are written in the background, one at a time.
+        self.ckpt_executor = ThreadPoolExecutor(max_workers=1)
+        self.ckpt_future = None
 
     def train_for_one_epoch(self, epoch, model, optim, scaler):
-        train_loss = 0
+        # Accumulated on the device so that the steps do not wait for the GPU to report each
+        # loss; synchronized once at the end of the epoch.
+        train_loss = torch.zeros(size=(), device=self.device)
+        steps_per_epoch = len(self.train_dl)
         pbar = tqdm(self.train_dl, leave=False)
         for step_idx, ori_image in enumerate(pbar): # "$x_{0} \sim q(x_{0})$"
             pbar.set_description("Training...")
 
-            ori_image = ori_image.to(self.device)
-            loss = model.get_loss(ori_image)
-            train_loss += (loss.item() / len(self.train_dl))
+            # Tells CUDA graphs of the compiled U-Net that a new training step begins, so
+            # that its outputs of the previous step may be overwritten.
+            torch.compiler.cudagraph_mark_step_begin()
+            ori_image = ori_image.to(
+                self.device, memory_format=model.memory_format, non_blocking=True,
+            )
+            loss = model.get_loss(ori_image, n_steps_per_image=self.n_steps_per_image)
+            train_loss += loss.detach()
 
-            optim.zero_grad()
+            optim.zero_grad(set_to_none=True)
+            # Gradients are clipped to $[-1, 1]$ once after the backward pass, with multi-tensor
+            # ops, and at their true scale.
             if scaler is not None:
                 scaler.scale(loss).backward()
+                scaler.unscale_(optim)
+                torch.nn.utils.clip_grad_value_(model.parameters(), clip_value=1)
                 scaler.step(optim)
                 scaler.update()
             else:
                 loss.backward()
+                torch.nn.utils.clip_grad_value_(model.parameters(), clip_value=1)
                 optim.step()
             # self.ema.step(cur_model=model)
 
-            self.scheduler.step((epoch - 1) * len(self.train_dl) + step_idx)
-        return train_loss
+            self.scheduler.step((epoch - 1) * steps_per_epoch + step_idx)
+        return train_loss.item() / steps_per_epoch
 
     @torch.inference_mode()
     def validate(self, model):
-        val_loss = 0
-        pbar = tqdm(self.val_dl, leave=False)
+        val_loss = torch.zeros(size=(), device=self.device)
+        pbar = tqdm(islice(self.val_dl, self.n_val_batches), total=self.n_val_batches, leave=False)
         for ori_image in pbar:
             pbar.set_description("Validating...")
 
-            ori_image = ori_image.to(self.device)
+            ori_image = ori_image.to(
+                self.device, memory_format=model.memory_format, non_blocking=True,
+            )
             loss = model.get_loss(ori_image.detach())
-            val_loss += (loss.item() / len(self.val_dl))
-        return val_loss
-
-    @staticmethod
-    def save_model_params(model, save_path):
-        Path(save_path).parent.mkdir(parents=True, exist_ok=True)
-        torch.save(modify_state_dict(model.state_dict()), str(save_path))
-        print(f"Saved model params as '{str(save_path)}'.")
-
-    def save_ckpt(self, epoch, model, optim, min_val_loss, scaler):
+            val_loss += loss
+        return val_loss.item() / self.n_val_batches
+
+    def _write_ckpt(self, ckpt, model_params_path=None):
+        # Written to a temporary file first, so that a crash while saving does not corrupt the
+        # previous checkpoint.
+        tmp_path = self.ckpt_path.with_suffix(".tmp")
+        torch.save(ckpt, str(tmp_path))
+        os.replace(tmp_path, self.ckpt_path)
+
+        # The model params alone (for `sample.py` and `eval.py`) are written from the same
+        # snapshot instead of a second copy of the state dict.
+        if model_params_path is not None:
+            torch.save(ckpt["model"], str(model_params_path))
+            print(f"Saved model params as '{str(model_params_path)}'.")
+
+    def wait_for_ckpt(self):
+        if self.ckpt_future is not None:
+            self.ckpt_future.result()
+            self.ckpt_future = None
+
+    def save_ckpt(self, epoch, model, optim, min_val_loss, scaler, model_params_path=None):
         self.ckpt_path.parent.mkdir(parents=True, exist_ok=True)
+        # Snapshotted to the CPU so that the next epoch can start while it is being written.
         ckpt = {
             "epoch": epoch,
-            "model": modify_state_dict(model.state_dict()),
-            "optimizer": optim.state_dict(),
+            "model": to_cpu(modify_state_dict(model.state_dict())),
+            "optimizer": to_cpu(optim.state_dict()),
             "min_val_loss": min_val_loss,
         }
         if scaler is not None:
             ckpt["scaler"] = scaler.state_dict()
-        torch.save(ckpt, str(self.ckpt_path))
+        self.wait_for_ckpt()
+        self.ckpt_future = self.ckpt_executor.submit(self._write_ckpt, ckpt, model_params_path)
 
     @torch.inference_mode()
     def test_sampling(self, epoch, model, batch_size):
         gen_image = model.sample(batch_size=batch_size)
         gen_grid = image_to_grid(gen_image, n_cols=int(batch_size ** 0.5))
-        sample_path = str(self.save_dir/f"sample-epoch={epoch}.jpg")
-        save_image(gen_grid, save_path=sample_path)
-        wandb.log({"Samples": wandb.Image(sample_path)}, step=epoch)
+        if self.save_samples:
+            save_image(gen_grid, save_path=self.save_dir/f"sample-epoch={epoch}.jpg")
+        # Logged from memory rather than re-read from the saved JPEG.
+        wandb.log({"Samples": wandb.Image(gen_grid)}, step=epoch)
 
     def train(self, n_epochs, model, optim, scaler, n_warmup_steps):
-        for param in model.parameters():
-            try:
-                param.register_hook(lambda grad: torch.clip(grad, -1, 1))
-            except Exception:
-                continue
-
-        model = torch.compile(model)
         # self.ema = EMA(weight=0.995, model=model)
 
         self.scheduler = CosineLRScheduler(
@@ -179,40 +257,53 @@ class Trainer(object):
 
         init_epoch = 0
         min_val_loss = math.inf
-        for epoch in range(init_epoch + 1, n_epochs + 1):
-            start_time = time()
-            train_loss = self.train_for_one_epoch(
-                epoch=epoch, model=model, optim=optim, scaler=scaler,
-            )
-            # val_loss = self.validate(self.ema.ema_model)
-            val_loss = self.validate(model)
-            if val_loss < min_val_loss:
-                model_params_path = str(self.save_dir/f"epoch={epoch}-val_loss={val_loss:.4f}.pth")
-                # self.save_model_params(model=self.ema.ema_model, save_path=model_params_path)
-                self.save_model_params(model=model, save_path=model_params_path)
-                min_val_loss = val_loss
-
-            self.save_ckpt(
-                epoch=epoch,
-                # model=self.ema.ema_model,
-                model=model,
-                optim=optim,
-                min_val_loss=min_val_loss,
-                scaler=scaler,
-            )
-
-            # self.test_sampling(epoch=epoch, model=self.ema.ema_model, batch_size=16)
-            self.test_sampling(epoch=epoch, model=model, batch_size=16)
-
-            log = f"[ {get_elapsed_time(start_time)} ]"
-            log += f"[ {epoch}/{n_epochs} ]"
-            log += f"[ Train loss: {train_loss:.4f} ]"
-            log += f"[ Val loss: {val_loss:.4f} | Best: {min_val_loss:.4f} ]"
-            print(log)
-            wandb.log(
-                {"Train loss": train_loss, "Val loss": val_loss, "Min val loss": min_val_loss},
-                step=epoch,
-            )
+        # Autograd allocates many short-lived objects on every step, and the automatic
+        # collections they trigger stall random steps.
+        gc.disable()
+        try:
+            for epoch in range(init_epoch + 1, n_epochs + 1):
+                start_time = time()
+                train_loss = self.train_for_one_epoch(
+                    epoch=epoch, model=model, optim=optim, scaler=scaler,
+                )
+                # val_loss = self.validate(self.ema.ema_model)
+                val_loss = self.validate(model)
+                # Collected once per epoch, between training and checkpointing, instead of at
+                # unpredictable points within the training steps.
+                gc.collect()
+                model_params_path = None
+                if val_loss < min_val_loss:
+                    model_params_path = self.save_dir/f"epoch={epoch}-val_loss={val_loss:.4f}.pth"
+                    min_val_loss = val_loss
+
+                if model_params_path is not None or epoch % self.ckpt_every == 0:
+                    self.save_ckpt(
+                        epoch=epoch,
+                        # model=self.ema.ema_model,
+                        model=model,
+                        optim=optim,
+                        min_val_loss=min_val_loss,
+                        scaler=scaler,
+                        model_params_path=model_params_path,
+                    )
+
+                # self.test_sampling(epoch=epoch, model=self.ema.ema_model, batch_size=16)
+                self.test_sampling(epoch=epoch, model=model, batch_size=16)
+
+                log = f"[ {get_elapsed_time(start_time)} ]"
+                log += f"[ {epoch}/{n_epochs} ]"
+                log += f"[ Train loss: {train_loss:.4f} ]"
+                log += f"[ Val loss: {val_loss:.4f} | Best: {min_val_loss:.4f} ]"
+                print(log)
+                wandb.log(
+                    {"Train loss": train_loss, "Val loss": val_loss, "Min val loss": min_val_loss},
+                    step=epoch,
+                )
+        finally:
+            gc.enable()
+
+        self.wait_for_ckpt()
+        self.ckpt_executor.shutdown()
 
 
 def main():
@@ -220,7 +311,7 @@ def main():
 
     DEVICE = get_device()
     args = get_args()
-    set_seed(args.SEED)
+    set_seed(args.SEED, deterministic=args.DETERMINISTIC)
     print(f"[ DEVICE: {DEVICE} ]")
 
     gc.collect()
@@ -233,21 +324,39 @@ def main():
         data_dir=args.DATA_DIR,
         img_size=args.IMG_SIZE,
         batch_size=args.BATCH_SIZE,
-        n_cpus=args.N_CPUS,
+        num_workers=args.N_CPUS,
+        # Page-locked batches only speed up copies to a CUDA device.
+        pin_memory=DEVICE.type == "cuda",
+        cache_dir=args.CACHE_DIR,
     )
     trainer = Trainer(
         train_dl=train_dl,
         val_dl=val_dl,
         save_dir=args.SAVE_DIR,
         device=DEVICE,
+        save_samples=args.SAVE_SAMPLES,
+        ckpt_every=args.CKPT_EVERY,
+        val_batches=args.VAL_BATCHES,
+        n_steps_per_image=args.N_STEPS_PER_IMAGE,
     )
 
     net = UNet()
-    model = DDPM(model=net, img_size=args.IMG_SIZE, device=DEVICE)
+    AUTOCAST_DTYPE = get_autocast_dtype(device=DEVICE)
+    model = DDPM(
+        model=net,
+        img_size=args.IMG_SIZE,
+        device=DEVICE,
+        sampling_dtype=AUTOCAST_DTYPE,
+        autocast_dtype=AUTOCAST_DTYPE,
+        compile_mode=args.COMPILE_MODE,
+    )
     print_n_params(model)
     # "We set the batch size to 128 for CIFAR10 and 64 for larger images."
-    optim = AdamW(model.parameters(), lr=args.LR)
-    scaler = get_grad_scaler(device=DEVICE)
+    # On CUDA, the update of all parameters runs as a single fused kernel rather than several
+    # elementwise kernels per parameter. The step is not part of any captured CUDA graph, so
+    # `capturable` is left off.
+    optim = AdamW(model.parameters(), lr=args.LR, fused=DEVICE.type == "cuda")
+    scaler = get_grad_scaler(device=DEVICE, autocast_dtype=AUTOCAST_DTYPE)
 
     trainer.train(
         n_epochs=args.N_EPOCHS,
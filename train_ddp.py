@@ -9,8 +9,12 @@ import torch.distributed as dist
 import torch.multiprocessing as mp
 from torch.nn.parallel import DistributedDataParallel as DDP
 import gc
+import os
+import contextlib
 import argparse
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 import math
 from time import time
 from tqdm import tqdm
@@ -19,12 +23,16 @@ import wandb
 
 from utils import (
     set_seed,
+    enable_tf32,
+    get_autocast_dtype,
     get_grad_scaler,
     get_elapsed_time,
     modify_state_dict,
     print_n_params,
+    to_cpu,
     image_to_grid,
     save_image,
+    positive_int,
 )
 from data import get_train_and_val_dls_ddp
 from unet import UNet
@@ -42,10 +50,36 @@ def get_args():
     parser.add_argument("--num_workers", type=int, required=True)
     parser.add_argument("--n_warmup_steps", type=int, required=True)
     parser.add_argument("--img_size", type=int, required=True)
+    # Directory of the images cached by `preprocess.py`; `data_dir` is read if not given.
+    parser.add_argument("--cache_dir", type=str, default=None, required=False)
     parser.add_argument("--rank", type=int, default=0, required=False)
     parser.add_argument("--port", type=int, default=12345, required=False)
 
+    # Number of micro-batches whose gradients are accumulated per optimizer step.
+    parser.add_argument("--accum_steps", type=int, default=1, required=False)
+    # Mode of `torch.compile` for the U-Net; "reduce-overhead" replays CUDA graphs of each
+    # training step.
+    parser.add_argument(
+        "--compile_mode",
+        type=str,
+        choices=("default", "reduce-overhead", "max-autotune", "max-autotune-no-cudagraphs"),
+        default=None,
+        required=False,
+    )
+    # The checkpoint is saved every `ckpt_every` epochs, and whenever the val loss improves.
+    parser.add_argument("--ckpt_every", type=int, default=5, required=False)
+    # Validate on only the first `val_batches` batches of the val set instead of all of them.
+    parser.add_argument("--val_batches", type=positive_int, default=None, required=False)
+    # Number of diffusion steps each training image is noised at per training step; the
+    # U-Net then sees `batch_size * n_steps_per_image` samples per step.
+    parser.add_argument(
+        "--n_steps_per_image", type=positive_int, default=1, required=False,
+    )
+    # Also write the samples logged to W&B after each epoch to `save_dir`.
+    parser.add_argument("--save_samples", action="store_true")
     parser.add_argument("--seed", type=int, default=223, required=False)
+    # Restrict cuDNN to deterministic algorithms instead of autotuning for the fastest ones.
+    parser.add_argument("--deterministic", action="store_true")
 
     args = parser.parse_args()
 
@@ -58,20 +92,48 @@ def get_args():
 
 
 class Trainer(object):
-    def __init__(self, run, train_dl, val_dl, save_dir, device, rank):
+    def __init__(
+        self,
+        run,
+        train_dl,
+        val_dl,
+        save_dir,
+        device,
+        rank,
+        save_samples=False,
+        ckpt_every=5,
+        val_batches=None,
+        n_steps_per_image=1,
+    ):
         self.run = run
         self.train_dl = train_dl
         self.val_dl = val_dl
         self.save_dir = Path(save_dir)
         self.device = device
         self.rank = rank
+        self.save_samples = save_samples
+        self.ckpt_every = ckpt_every
+        self.n_steps_per_image = n_steps_per_image
+        # The val loss is a Monte Carlo estimate over random diffusion steps anyway, so a
+        # subset of the val set is enough to monitor it.
+        if val_batches is None:
+            self.n_val_batches = len(val_dl)
+        else:
+            self.n_val_batches = min(val_batches, len(val_dl))
+        assert self.n_val_batches > 0, "The val set yields no batch to validate on."
 
         self.ckpt_path = self.save_dir/self.run.name/"ckpt.pth"
+        # Checkpoints are written in the background, one at a time.
+        self.ckpt_executor = ThreadPoolExecutor(max_workers=1)
+        self.ckpt_future = None
 
-    def train_for_one_epoch(self, epoch, model, optim, scaler):
+    def train_for_one_epoch(self, epoch, model, optim, scaler, accum_steps=1):
         self.train_dl.sampler.set_epoch(epoch)
 
-        train_loss = 0
+        # Accumulated on the device so that the steps do not wait for the GPU to report each
+        # loss; synchronized once at the end of the epoch.
+        train_loss = torch.zeros(size=(), device=self.device)
+        steps_per_epoch = len(self.train_dl)
         if self.rank == 0:
             pbar = tqdm(self.train_dl, leave=False)
         else:
@@ -80,75 +142,111 @@ class Trainer(object):
             if self.rank == 0:
                 pbar.set_description("Training...")
 
-            ori_image = ori_image.to(self.device)
-            print(ori_image.shape)
-            loss = model.module.get_loss(ori_image)
-            train_loss += (loss.item() / len(self.train_dl))
-
-            optim.zero_grad()
-            if scaler is not None:
-                scaler.scale(loss).backward()
-                scaler.step(optim)
-                scaler.update()
-            else:
-                loss.backward()
-                optim.step()
-
-            self.scheduler.step((epoch - 1) * len(self.train_dl) + step_idx)
-        return train_loss
+            # Tells CUDA graphs of the compiled U-Net that a new training step begins, so
+            # that its outputs of the previous step may be overwritten.
+            torch.compiler.cudagraph_mark_step_begin()
+            ori_image = ori_image.to(
+                self.device, memory_format=model.module.memory_format, non_blocking=True,
+            )
+            if step_idx % accum_steps == 0:
+                optim.zero_grad(set_to_none=True)
+                # The last accumulation of the epoch is shorter if `accum_steps` does not divide
+                # the number of steps, and still ends with an optimizer step.
+                n_accum_steps = min(accum_steps, steps_per_epoch - step_idx)
+            # Only the last micro-batch of each accumulation all-reduces the gradients; the
+            # others only accumulate them locally.
+            is_last = (step_idx + 1) % accum_steps == 0 or step_idx + 1 == steps_per_epoch
+            with model.no_sync() if not is_last else contextlib.nullcontext():
+                loss = model.module.get_loss(
+                    ori_image, denoiser=model, n_steps_per_image=self.n_steps_per_image,
+                )
+                train_loss += loss.detach()
+
+                if scaler is not None:
+                    scaler.scale(loss / n_accum_steps).backward()
+                else:
+                    (loss / n_accum_steps).backward()
+            if is_last:
+                if scaler is not None:
+                    scaler.step(optim)
+                    scaler.update()
+                else:
+                    optim.step()
+
+            self.scheduler.step((epoch - 1) * steps_per_epoch + step_idx)
+        return train_loss.item() / steps_per_epoch
 
     @torch.inference_mode()
     def validate(self, model):
-        val_loss = 0
+        val_loss = torch.zeros(size=(), device=self.device)
         if self.rank == 0:
-            pbar = tqdm(self.val_dl, leave=False)
+            pbar = tqdm(
+                islice(self.val_dl, self.n_val_batches), total=self.n_val_batches, leave=False,
+            )
         else:
-            pbar = self.val_dl
+            pbar = islice(self.val_dl, self.n_val_batches)
         for ori_image in pbar:
             if self.rank == 0:
                 pbar.set_description("Validating...")
 
-            ori_image = ori_image.to(self.device)
+            ori_image = ori_image.to(
+                self.device, memory_format=model.module.memory_format, non_blocking=True,
+            )
             loss = model.module.get_loss(ori_image.detach())
-            val_loss += (loss.item() / len(self.val_dl))
-        return val_loss
-
-    @staticmethod
-    def save_model_params(model, save_path):
-        Path(save_path).parent.mkdir(parents=True, exist_ok=True)
-        torch.save(modify_state_dict(model.module.state_dict()), str(save_path))
-        print(f"Saved model params as '{str(save_path)}'.")
-
-    def save_ckpt(self, epoch, model, optim, min_val_loss, scaler):
+            val_loss += loss
+        return val_loss.item() / self.n_val_batches
+
+    def _write_ckpt(self, ckpt, model_params_path=None):
+        # Written to a temporary file first, so that a crash while saving does not corrupt the
+        # previous checkpoint.
+        tmp_path = self.ckpt_path.with_suffix(".tmp")
+        torch.save(ckpt, str(tmp_path))
+        os.replace(tmp_path, self.ckpt_path)
+
+        # The model params alone (for `sample.py` and `eval.py`) are written from the same
+        # snapshot instead of a second copy of the state dict.
+        if model_params_path is not None:
+            torch.save(ckpt["model"], str(model_params_path))
+            print(f"Saved model params as '{str(model_params_path)}'.")
+
+    def wait_for_ckpt(self):
+        if self.ckpt_future is not None:
+            self.ckpt_future.result()
+            self.ckpt_future = None
+
+    def save_ckpt(self, epoch, model, optim, min_val_loss, scaler, model_params_path=None):
         if self.rank == 0:
             self.ckpt_path.parent.mkdir(parents=True, exist_ok=True)
+            # Snapshotted to the CPU so that the next epoch can start while it is being written.
             ckpt = {
                 "epoch": epoch,
-                "model": modify_state_dict(model.module.state_dict()),
-                "optimizer": optim.state_dict(),
+                "model": to_cpu(modify_state_dict(model.module.state_dict())),
+                "optimizer": to_cpu(optim.state_dict()),
                 "min_val_loss": min_val_loss,
             }
             if scaler is not None:
                 ckpt["scaler"] = scaler.state_dict()
-            torch.save(ckpt, str(self.ckpt_path))
+            self.wait_for_ckpt()
+            self.ckpt_future = self.ckpt_executor.submit(
+                self._write_ckpt, ckpt, model_params_path,
+            )
 
     @torch.inference_mode()
     def test_sampling(self, epoch, model, batch_size):
         if self.rank == 0:
             gen_image = model.module.sample(batch_size=batch_size)
             gen_grid = image_to_grid(gen_image, n_cols=int(batch_size ** 0.5))
-            sample_path = str(
-                self.save_dir/self.run.name/f"sample-epoch={epoch}.jpg"
-            )
-            save_image(gen_grid, save_path=sample_path)
-            wandb.log({"Samples": wandb.Image(sample_path)}, step=epoch)
+            if self.save_samples:
+                save_image(
+                    gen_grid, save_path=self.save_dir/self.run.name/f"sample-epoch={epoch}.jpg",
+                )
+            # Logged from memory rather than re-read from the saved JPEG.
+            wandb.log({"Samples": wandb.Image(gen_grid)}, step=epoch)
 
-    def train(self, n_epochs, model, optim, scaler, n_warmup_steps):
+    def train(self, n_epochs, model, optim, scaler, n_warmup_steps, accum_steps=1):
         if self.rank == 0:
             print_n_params(model)
 
-        model = torch.compile(model)
-
         self.scheduler = CosineLRScheduler(
             optimizer=optim,
             t_initial=n_epochs * len(self.train_dl),
@@ -160,40 +258,57 @@ class Trainer(object):
 
         init_epoch = 0
         min_val_loss = math.inf
-        for epoch in range(init_epoch + 1, n_epochs + 1):
-            start_time = time()
-            train_loss = self.train_for_one_epoch(
-                epoch=epoch, model=model, optim=optim, scaler=scaler,
-            )
-            val_loss = self.validate(model)
-            if val_loss < min_val_loss and self.rank == 0:
-                model_params_path = str(
-                    self.save_dir/self.run.name/f"epoch={epoch}-val_loss={val_loss:.4f}.pth"
-                )
-                self.save_model_params(model=model, save_path=model_params_path)
-                min_val_loss = val_loss
-
-            self.save_ckpt(
-                epoch=epoch,
-                model=model,
-                optim=optim,
-                min_val_loss=min_val_loss,
-                scaler=scaler,
-            )
-
-            self.test_sampling(epoch=epoch, model=model, batch_size=16)
-
-            if self.rank == 0:
-                log = f"[ {get_elapsed_time(start_time)} ]"
-                log += f"[ {epoch}/{n_epochs} ]"
-                log += f"[ Train loss: {train_loss:.4f} ]"
-                log += f"[ Val loss: {val_loss:.4f} | Best: {min_val_loss:.4f} ]"
-                print(log)
-                wandb.log(
-                    {"Train loss": train_loss, "Val loss": val_loss, "Min val loss": min_val_loss},
-                    step=epoch,
+        # Autograd allocates many short-lived objects on every step, and the automatic
+        # collections they trigger stall random steps.
+        gc.disable()
+        try:
+            for epoch in range(init_epoch + 1, n_epochs + 1):
+                start_time = time()
+                train_loss = self.train_for_one_epoch(
+                    epoch=epoch, model=model, optim=optim, scaler=scaler, accum_steps=accum_steps,
                 )
-
+                val_loss = self.validate(model)
+                # Collected once per epoch, between training and checkpointing, instead of at
+                # unpredictable points within the training steps.
+                gc.collect()
+                model_params_path = None
+                if val_loss < min_val_loss and self.rank == 0:
+                    model_params_path = (
+                        self.save_dir/self.run.name/f"epoch={epoch}-val_loss={val_loss:.4f}.pth"
+                    )
+                    min_val_loss = val_loss
+
+                if model_params_path is not None or epoch % self.ckpt_every == 0:
+                    self.save_ckpt(
+                        epoch=epoch,
+                        model=model,
+                        optim=optim,
+                        min_val_loss=min_val_loss,
+                        scaler=scaler,
+                        model_params_path=model_params_path,
+                    )
+
+                self.test_sampling(epoch=epoch, model=model, batch_size=16)
+
+                if self.rank == 0:
+                    log = f"[ {get_elapsed_time(start_time)} ]"
+                    log += f"[ {epoch}/{n_epochs} ]"
+                    log += f"[ Train loss: {train_loss:.4f} ]"
+                    log += f"[ Val loss: {val_loss:.4f} | Best: {min_val_loss:.4f} ]"
+                    print(log)
+                    wandb.log(
+                        {
+                            "Train loss": train_loss,
+                            "Val loss": val_loss,
+                            "Min val loss": min_val_loss,
+                        },
+                        step=epoch,
+                    )
+        finally:
+            gc.enable()
+
+        self.wait_for_ckpt()
+        self.ckpt_executor.shutdown()
         self.run.finish()
 
 
@@ -201,21 +316,32 @@ class DistDataParallel(object):
     def __init__(self, args):
         self.args = args
 
+    @staticmethod
+    def is_torchrun():
+        return "LOCAL_RANK" in os.environ
+
     def setup(self, rank, world_size, port):
-        dist.init_process_group(
-            backend="nccl",
-            init_method=f"tcp://localhost:{port}",
-            rank=rank,
-            world_size=world_size,
-        )
+        if self.is_torchrun():
+            # `torchrun` sets the rank, the world size and the rendezvous address.
+            dist.init_process_group(backend="nccl")
+        else:
+            dist.init_process_group(
+                backend="nccl",
+                init_method=f"tcp://localhost:{port}",
+                rank=rank,
+                world_size=world_size,
+            )
 
     def cleanup(self):
         dist.destroy_process_group()
 
     def main_worker(self, rank, workld_size, run):
         self.setup(rank=rank, world_size=workld_size, port=self.args.PORT)
-        DEVICE = torch.device(f"cuda:{rank}")
-        set_seed(self.args.SEED + rank)
+        local_rank = int(os.environ.get("LOCAL_RANK", rank))
+        DEVICE = torch.device(f"cuda:{local_rank}")
+        torch.cuda.set_device(DEVICE)
+        set_seed(self.args.SEED + rank, deterministic=self.args.DETERMINISTIC)
+        enable_tf32()
         print(f"[ DEVICE: {DEVICE} ][ RANK: {rank} ]")
 
         gc.collect()
@@ -231,6 +357,7 @@ class DistDataParallel(object):
             num_workers=self.args.NUM_WORKERS,
             rank=rank,
             world_size=workld_size,
+            cache_dir=self.args.CACHE_DIR,
         )
         trainer = Trainer(
             run=run,
@@ -239,14 +366,37 @@ class DistDataParallel(object):
             save_dir=self.args.SAVE_DIR,
             device=DEVICE,
             rank=rank,
+            save_samples=self.args.SAVE_SAMPLES,
+            ckpt_every=self.args.CKPT_EVERY,
+            val_batches=self.args.VAL_BATCHES,
+            n_steps_per_image=self.args.N_STEPS_PER_IMAGE,
         )
 
         net = UNet()
-        model = DDPM(model=net, img_size=self.args.IMG_SIZE, device=DEVICE)
-        model = DDP(model, device_ids=[rank])
+        AUTOCAST_DTYPE = get_autocast_dtype(device=DEVICE)
+        model = DDPM(
+            model=net,
+            img_size=self.args.IMG_SIZE,
+            device=DEVICE,
+            sampling_dtype=AUTOCAST_DTYPE,
+            autocast_dtype=AUTOCAST_DTYPE,
+            compile_mode=self.args.COMPILE_MODE,
+        )
+        # The gradients are all-reduced in buckets during the backward pass, and are views into
+        # the buckets so that they are not copied in and out. The buffers of `DDPM` are
+        # constants, so they are not broadcast before every forward pass.
+        model = DDP(
+            model,
+            device_ids=[local_rank],
+            gradient_as_bucket_view=True,
+            broadcast_buffers=False,
+        )
         # "We set the batch size to 128 for CIFAR10 and 64 for larger images."
-        optim = AdamW(model.parameters(), lr=self.args.LR)
-        scaler = get_grad_scaler(device=DEVICE)
+        # On CUDA, the update of all parameters runs as a single fused kernel rather than several
+        # elementwise kernels per parameter. The step is not part of any captured CUDA graph, so
+        # `capturable` is left off.
+        optim = AdamW(model.parameters(), lr=self.args.LR, fused=DEVICE.type == "cuda")
+        scaler = get_grad_scaler(device=DEVICE, autocast_dtype=AUTOCAST_DTYPE)
 
         trainer.train(
             n_epochs=self.args.N_EPOCHS,
@@ -254,24 +404,34 @@ class DistDataParallel(object):
             optim=optim,
             scaler=scaler,
             n_warmup_steps=self.args.N_WARMUP_STEPS,
+            accum_steps=self.args.ACCUM_STEPS,
         )
 
         self.cleanup()
 
     def run(self, run):
-        world_size = torch.cuda.device_count()
-        mp.spawn(
-            self.main_worker,
-            args=(world_size, run),
-            nprocs=world_size,
-            join=True,
-        )
+        if self.is_torchrun():
+            self.main_worker(
+                rank=int(os.environ["RANK"]), workld_size=int(os.environ["WORLD_SIZE"]), run=run,
+            )
+        else:
+            world_size = torch.cuda.device_count()
+            mp.spawn(
+                self.main_worker,
+                args=(world_size, run),
+                nprocs=world_size,
+                join=True,
+            )
 
 
 def main():
     args = get_args()
     ddp = DistDataParallel(args)
-    run = wandb.init(project="DDPM")
+    # Under `torchrun` every rank runs `main`, and only rank 0 logs.
+    if int(os.environ.get("RANK", 0)) == 0:
+        run = wandb.init(project="DDPM")
+    else:
+        run = wandb.init(project="DDPM", mode="disabled")
     ddp.run(run)
 
 
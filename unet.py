@@ -4,12 +4,24 @@
 import torch
 from torch import nn
 from torch.nn import functional as F
+from torch.nn.attention import SDPBackend, sdpa_kernel
 import math
-
-
-class Swish(nn.Module):
-    def forward(self, x):
-        return x * torch.sigmoid(x)
+import inspect
+
+# Fused attention kernels first; the math fallback only for inputs they do not support.
+# `AttnBlock` is single-headed with a head dimension of up to 256, which FlashAttention-2 and
+# cuDNN attention both accept for FP16 and BF16 inputs.
+SDPA_BACKENDS = [
+    SDPBackend.FLASH_ATTENTION,
+    SDPBackend.CUDNN_ATTENTION,
+    SDPBackend.EFFICIENT_ATTENTION,
+    SDPBackend.MATH,
+]
+# `sdpa_kernel` only follows the order of the backends with `set_priority=True` (PyTorch 2.6+);
+# older versions just enable them and keep their default order.
+SDPA_KERNEL_KWARGS = (
+    {"set_priority": True} if "set_priority" in inspect.signature(sdpa_kernel).parameters else {}
+)
 
 
 class TimeEmbedding(nn.Module):
@@ -20,7 +32,7 @@ class TimeEmbedding(nn.Module):
         emb = torch.arange(0, d_model, step=2) / d_model * math.log(10000)
         emb = torch.exp(-emb)
         pos = torch.arange(max_len).float()
-        emb = pos[:, None] * emb[None, :]
+        emb = torch.outer(pos, emb)
         assert list(emb.shape) == [max_len, d_model // 2]
         emb = torch.stack([torch.sin(emb), torch.cos(emb)], dim=-1)
         assert list(emb.shape) == [max_len, d_model // 2, 2]
@@ -29,7 +41,7 @@ class TimeEmbedding(nn.Module):
         self.timembedding = nn.Sequential(
             nn.Embedding.from_pretrained(emb),
             nn.Linear(d_model, dim),
-            Swish(),
+            nn.SiLU(),
             nn.Linear(dim, dim),
         )
 
@@ -53,9 +65,33 @@ class UpSample(nn.Module):
         super().__init__()
         self.main = nn.Conv2d(in_ch, in_ch, 3, stride=1, padding=1)
 
+        # After a 2x nearest-neighbor upsampling, the 3x3 taps of an output pixel at
+        # sub-pixel phase `a` (along one axis) land on only two input pixels: phase 0 reads
+        # rows `i - 1` (tap 0) and `i` (taps 1 and 2), phase 1 reads rows `i` (taps 0 and 1)
+        # and `i + 1` (tap 2). `phase_map[a]` maps the 3 taps onto offsets -1, 0 and +1.
+        phase_map = torch.tensor(
+            [
+                [[1, 0, 0], [0, 1, 1], [0, 0, 0]],
+                [[0, 0, 0], [1, 1, 0], [0, 0, 1]],
+            ],
+            dtype=torch.float,
+        )
+        self.register_buffer("phase_map", phase_map, persistent=False)
+
     def forward(self, x):
-        x = F.interpolate(x, scale_factor=2, mode="nearest")
-        x = self.main(x)
+        # Same as `F.interpolate(x, scale_factor=2, mode="nearest")` followed by `self.main`,
+        # but the four sub-pixel phases are computed by one 3x3 conv at the input resolution
+        # and interleaved by `F.pixel_shuffle`, so the 4x larger upsampled input is never
+        # materialized. The weights are still those of `self.main`.
+        weight = torch.einsum(
+            "aik,bjl,ockl->oabcij",
+            self.phase_map.to(self.main.weight.dtype),
+            self.phase_map.to(self.main.weight.dtype),
+            self.main.weight,
+        ).flatten(0, 2)
+        bias = self.main.bias.repeat_interleave(4)
+        x = F.conv2d(x, weight=weight, bias=bias, stride=1, padding=1)
+        x = F.pixel_shuffle(x, upscale_factor=2)
         return x
 
 
@@ -71,20 +107,23 @@ class AttnBlock(nn.Module):
     def forward(self, x):
         B, C, H, W = x.shape
         h = self.group_norm(x)
-        q = self.proj_q(h)
-        k = self.proj_k(h)
-        v = self.proj_v(h)
-
-        q = q.permute(0, 2, 3, 1).view(B, H * W, C)
-        k = k.view(B, C, H * W)
-        w = torch.bmm(q, k) * (int(C) ** (-0.5))
-        assert list(w.shape) == [B, H * W, H * W]
-        w = F.softmax(w, dim=-1)
-
-        v = v.permute(0, 2, 3, 1).view(B, H * W, C)
-        h = torch.bmm(w, v)
-        assert list(h.shape) == [B, H * W, C]
-        h = h.view(B, H, W, C).permute(0, 3, 1, 2)
+        # Project q, k and v with a single 1x1 conv over the stacked weights, then split the
+        # result straight into the `(B, 1, H * W, C)` layout of SDPA, with unit stride along
+        # `C`, instead of reshaping each projection separately.
+        qkv = F.conv2d(
+            h,
+            weight=torch.cat([self.proj_q.weight, self.proj_k.weight, self.proj_v.weight], dim=0),
+            bias=torch.cat([self.proj_q.bias, self.proj_k.bias, self.proj_v.bias], dim=0),
+        )
+        q, k, v = qkv.permute(0, 2, 3, 1).reshape(B, 1, H * W, 3, C).unbind(dim=3)
+
+        # Single-head attention over the `H * W` positions. SDPA dispatches to fused
+        # kernels that never materialize the `(H * W, H * W)` score matrix and scales by
+        # `C ** (-0.5)` itself.
+        with sdpa_kernel(SDPA_BACKENDS, **SDPA_KERNEL_KWARGS):
+            h = F.scaled_dot_product_attention(q, k, v)
+        assert list(h.shape) == [B, 1, H * W, C]
+        h = h.reshape(B, H, W, C).permute(0, 3, 1, 2)
         h = self.proj(h)
 
         return x + h
@@ -95,16 +134,16 @@ class ResBlock(nn.Module):
         super().__init__()
         self.block1 = nn.Sequential(
             nn.GroupNorm(32, in_ch),
-            Swish(),
+            nn.SiLU(),
             nn.Conv2d(in_ch, out_ch, 3, stride=1, padding=1),
         )
         self.temb_proj = nn.Sequential(
-            Swish(),
+            nn.SiLU(),
             nn.Linear(tdim, out_ch),
         )
         self.block2 = nn.Sequential(
             nn.GroupNorm(32, out_ch),
-            Swish(),
+            nn.SiLU(),
             nn.Dropout(dropout),
             nn.Conv2d(out_ch, out_ch, 3, stride=1, padding=1),
         )
@@ -119,7 +158,9 @@ class ResBlock(nn.Module):
 
     def forward(self, x, temb):
         h = self.block1(x)
-        h = h + self.temb_proj(temb)[:, :, None, None]
+        # `block1` ends with a conv, whose backward does not need its output, so the time
+        # embedding can be added in place instead of into a new activation.
+        h += self.temb_proj(temb)[:, :, None, None]
         h = self.block2(h)
 
         h = h + self.shortcut(x)
@@ -177,30 +218,45 @@ class UNet(nn.Module):
 
         self.tail = nn.Sequential(
             nn.GroupNorm(32, cur_ch),
-            Swish(),
+            nn.SiLU(),
             nn.Conv2d(cur_ch, 3, kernel_size=3, stride=1, padding=1)
         )
 
-    def forward(self, noisy_image, diffusion_step):
-        temb = self.time_embedding(diffusion_step)
+        # Whether each layer is a `ResBlock`, which takes the time embedding (and, on the way up,
+        # a skip connection), resolved once instead of by type checks on every forward pass.
+        self._down_takes_temb = [not isinstance(layer, DownSample) for layer in self.downblocks]
+        self._up_takes_temb = [not isinstance(layer, UpSample) for layer in self.upblocks]
+
+    def precompute_time_embeddings(self, n_diffusion_steps, device):
+        return self.time_embedding(torch.arange(n_diffusion_steps, device=device))
+
+    def forward(self, noisy_image, diffusion_step, temb=None):
+        # `diffusion_step` is either one diffusion step per sample or a single one (an `int` or
+        # a 0-dim tensor) shared by the whole batch, whose embedding is then computed once.
+        if temb is None:
+            temb = self.time_embedding(
+                torch.as_tensor(diffusion_step, device=noisy_image.device),
+            )
+        if temb.dim() == 1:
+            temb = temb.expand(noisy_image.size(0), -1)
         x = self.head(noisy_image)
         xs = [x]
-        for layer in self.downblocks:
-            if isinstance(layer, DownSample):
-                x = layer(x)
-            else:
+        for layer, takes_temb in zip(self.downblocks, self._down_takes_temb):
+            if takes_temb:
                 x = layer(x, temb)
+            else:
+                x = layer(x)
             xs.append(x)
 
         for layer in self.middleblocks:
             x = layer(x, temb)
 
-        for layer in self.upblocks:
-            if isinstance(layer, UpSample):
-                x = layer(x)
-            else:
+        for layer, takes_temb in zip(self.upblocks, self._up_takes_temb):
+            if takes_temb:
                 x = torch.cat([x, xs.pop()], dim=1)
                 x = layer(x, temb)
+            else:
+                x = layer(x)
         x = self.tail(x)
         assert len(xs) == 0
         return x
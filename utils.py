@@ -10,14 +10,21 @@ from datetime import timedelta
 from time import time
 from PIL import Image
 from pathlib import Path
-from collections import OrderedDict
 import random
 import numpy as np
 import os
 import re
+import argparse
 
 
-def set_seed(seed):
+def positive_int(x):
+    x = int(x)
+    if x < 1:
+        raise argparse.ArgumentTypeError(f"must be a positive integer, got {x}")
+    return x
+
+
+def set_seed(seed, deterministic=False):
     random.seed(seed)
     np.random.seed(seed)
     torch.manual_seed(seed)
@@ -25,12 +32,24 @@ def set_seed(seed):
     if torch.cuda.is_available():
         torch.cuda.manual_seed(seed)
         torch.cuda.manual_seed_all(seed)
-        torch.backends.cudnn.deterministic = True
+        # Deterministic convolution algorithms are often much slower, so unless bit-for-bit
+        # reproducibility is asked for, let cuDNN autotune the fastest one for each input shape
+        # instead.
+        torch.backends.cudnn.deterministic = deterministic
+        torch.backends.cudnn.benchmark = not deterministic
+
+
+def enable_tf32():
+    # Let FP32 matmuls and convolutions run on TF32 Tensor Cores on Ampere and newer GPUs.
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
+    torch.set_float32_matmul_precision("high")
 
 
 def get_device():
     if torch.cuda.is_available():
         device = torch.device("cuda")
+        enable_tf32()
     else:
         if torch.backends.mps.is_available():
             device = torch.device("mps")
@@ -39,8 +58,17 @@ def get_device():
     return device
 
 
-def get_grad_scaler(device):
-    return GradScaler() if device.type == "cuda" else None
+def get_autocast_dtype(device):
+    # BF16 has the exponent range of FP32, so on Ampere and newer GPUs it trains as fast as
+    # FP16 without loss scaling.
+    if device.type == "cuda" and torch.cuda.get_device_capability(device)[0] >= 8:
+        return torch.bfloat16
+    return torch.float16
+
+
+def get_grad_scaler(device, autocast_dtype=torch.float16):
+    # Loss scaling is only needed against the underflow of FP16 gradients.
+    return GradScaler() if device.type == "cuda" and autocast_dtype == torch.float16 else None
 
 
 def _to_pil(img):
@@ -73,7 +101,8 @@ def denorm(x, mean=(0.5, 0.5, 0.5), std=(0.5, 0.5, 0.5)):
 
 
 def image_to_grid(image, n_cols):
-    tensor = image.clone().detach().cpu()
+    # `denorm` is out of place, so the input needs no defensive copy.
+    tensor = image.detach().cpu()
     tensor = denorm(tensor)
     grid = make_grid(tensor, nrow=n_cols, padding=1, pad_value=1)
     grid.clamp_(0, 1)
@@ -81,12 +110,26 @@ def image_to_grid(image, n_cols):
     return grid
 
 
-def modify_state_dict(state_dict, pattern=r"^module.|^_orig_mod."):
-    new_state_dict = OrderedDict()
-    for old_key, value in state_dict.items():
-        new_key = re.sub(pattern=pattern, repl="", string=old_key)
-        new_state_dict[new_key] = value
-    return new_state_dict
+# Prefixes added to the state dict keys by `DistributedDataParallel` and `torch.compile`,
+# possibly stacked.
+WRAPPER_PREFIX_PATTERN = re.compile(r"^(?:module\.|_orig_mod\.)+")
+
+
+def modify_state_dict(state_dict, pattern=WRAPPER_PREFIX_PATTERN):
+    pattern = re.compile(pattern)
+    return {pattern.sub("", old_key): value for old_key, value in state_dict.items()}
+
+
+def to_cpu(x):
+    # Copy of the tensors in a (nested) state dict on the CPU, e.g., to save it while training
+    # goes on updating the originals in place.
+    if isinstance(x, torch.Tensor):
+        return x.detach().to("cpu", copy=True)
+    if isinstance(x, dict):
+        return type(x)((k, to_cpu(v)) for k, v in x.items())
+    if isinstance(x, (list, tuple)):
+        return type(x)(to_cpu(v) for v in x)
+    return x
 
 
 def print_n_params(model):